@@ -5,22 +5,31 @@ appropriate track tags to said files"""
 
 from __future__ import print_function
 import os
-import fnmatch
 import subprocess
 import shlex
 import re
 import tempfile
 import multiprocessing
-import itertools
 import logging
 import xml.etree.cElementTree as xml
-import hashlib
+import struct
+import zlib
+import math
+import threading
+import json
+import time
+import heapq
+import itertools
 try:
-    from StringIO import StringIO
+    import queue
 except ImportError:
-    from io import StringIO
+    import Queue as queue
 from argparse import ArgumentParser
 from collections import OrderedDict
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 LOGLEVELS = {
     "all": 0,
@@ -34,30 +43,110 @@ LOGLEVELS = {
 # sort, so we get descending order of loglevels, just for the argparser choices
 LOGLEVEL_NAMES = sorted(LOGLEVELS.keys(), key=LOGLEVELS.get, reverse=True)
 
+RG_ALGORITHM = "ITU-R BS.1770"
+MATROSKA_EXTENSIONS = (".mka", ".mkv", ".mk3d")
+# Files the discovery may hold back per worker process while they are all busy, so the most
+# expensive of them are started first.
+DISCOVERY_WINDOW = 4
+# File systems without a block device that seek like disks, their files are capped like on a HDD.
+NETWORK_FILESYSTEMS = ("nfs", "cifs", "smb", "fuse", "9p", "ceph", "afs")
+# ReplayGain 2.0 reference loudness, used by the native analyzer.
+RG2_REFERENCE = -18.0
+
+# WAVE_FORMAT_EXTENSIBLE speaker positions (bit numbers of the channel mask).
+WAV_SPEAKER_LFE = 3
+WAV_SPEAKER_SURROUND = (4, 5, 9, 10)
+DEFAULT_CHANNEL_MASKS = {1: 0x4, 2: 0x3, 3: 0x7, 4: 0x33, 5: 0x37, 6: 0x3F, 7: 0x13F, 8: 0x63F}
+
+# EBML / Matroska element IDs, see https://www.matroska.org/technical/elements.html
+EBML_HEADER = 0x1A45DFA3
+EBML_DOCTYPE = 0x4282
+EBML_VOID = 0xEC
+EBML_CRC32 = 0xBF
+MKV_SEGMENT = 0x18538067
+MKV_SEEKHEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEKID = 0x53AB
+MKV_SEEKPOSITION = 0x53AC
+MKV_CLUSTER = 0x1F43B675
+MKV_INFO = 0x1549A966
+MKV_TIMECODESCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACKENTRY = 0xAE
+MKV_TRACKNUMBER = 0xD7
+MKV_TRACKUID = 0x73C5
+MKV_TRACKTYPE = 0x83
+MKV_FLAGDEFAULT = 0x88
+MKV_TRACKTYPE_AUDIO = 2
+MKV_TAGS = 0x1254C367
+MKV_TAG = 0x7373
+MKV_TARGETS = 0x63C0
+MKV_TAGTRACKUID = 0x63C5
+MKV_SIMPLETAG = 0x67C8
+MKV_TAGNAME = 0x45A3
+MKV_TAGSTRING = 0x4487
+
 
 def main():
-    check_binaries()
+    started = time.time()
     log = Log()
     utils = Utils()
     utils.log = log
     CheckArgs(utils)
-    if not utils.files:
+    discovery = Discovery(utils)
+    PoolMkvrg(utils, discovery)
+    if not discovery.found:
         utils.log.warning("No files found to process.")
-
-    ThreadMkvrg(utils)
+    utils.log.metrics_summary(started, utils.metrics_prom)
+    if utils.metrics_tmp:
+        os.remove(utils.metrics)
     return 0
 
 
-def process_thread(thread, queue, utils):
-    while True:
-        work = queue.get()
-        if not work:
-            queue.task_done()
-            return
-        matroska_file = utils.files[work]
-        matroska_file.set_thread(thread)
-        matroska_file.process_file()
-        queue.task_done()
+def process_work(matroska_file):
+    """Pool worker, processes a single MatroskaFile, returns its path and album measurements."""
+    matroska_file.set_thread(multiprocessing.current_process().name)
+    return matroska_file.get_path(), matroska_file.process_file()
+
+
+def has_ebml_magic(path):
+    """Check if a file starts with the EBML magic number, with a single 4 byte read."""
+    try:
+        with open(path, "rb") as handle:
+            return handle.read(4) == struct.pack(">I", EBML_HEADER)
+    except (IOError, OSError):
+        return False
+
+
+def device_cap(path, device_jobs, hdd_jobs, threads):
+    """Amount of files that may be processed at once from the device holding path. With
+    device_jobs 0 it is hdd_jobs for rotational disks and network shares, threads otherwise."""
+    if device_jobs:
+        return device_jobs
+    device = os.stat(path).st_dev
+    major, minor = os.major(device), os.minor(device)
+    if major == 0:
+        # Not a block device, look up the file system type of the mount point holding path.
+        path, fstype = os.path.realpath(path), ""
+        try:
+            with open("/proc/self/mounts") as handle:
+                mounts = [line.split()[1:3] for line in handle]
+        except (IOError, OSError):
+            return threads
+        mounts = [(mount.replace("\\040", " "), kind) for mount, kind in mounts]
+        for mount, kind in sorted(mounts, key=lambda mount: len(mount[0])):
+            if path == mount or path.startswith(mount.rstrip("/") + "/"):
+                fstype = kind
+        return hdd_jobs if fstype.startswith(NETWORK_FILESYSTEMS) else threads
+    # Partitions have no queue, their disk does.
+    for queue_dir in ("queue", "../queue"):
+        try:
+            with open("/sys/dev/block/{}:{}/{}/rotational".format(major, minor, queue_dir)) as handle:
+                return hdd_jobs if handle.read().strip() == "1" else threads
+        except (IOError, OSError):
+            continue
+    return threads
 
 
 def check_binary(binary):
@@ -72,18 +161,22 @@ def check_binary(binary):
     return result
 
 
-def check_binaries():
+def check_binaries(binaries):
     """Check if all required binaries are in PATH."""
-    binaries = ["bs1770gain", "mkvpropedit", "mkvinfo"]
     for binary in binaries:
         if not check_binary(binary):
             print("ERROR: The program '" + binary + "' is required.")
             exit(1)
 
 
+# Amount of external programs started by this process, for the --metrics.
+SPAWNS = [0]
+
+
 def run_command(command, stderr=None, universal_newlines=False):
     """Run a command in a shell, return the output as a string."""
     ret = ""
+    SPAWNS[0] += 1
     try:
         ret = str(subprocess.check_output(shlex.split(command), stderr=stderr,
                                           universal_newlines=universal_newlines))
@@ -94,6 +187,23 @@ def run_command(command, stderr=None, universal_newlines=False):
     return ret
 
 
+def iter_command(command, stderr=None):
+    """Run a command, yield the lines of its output as they are written instead of buffering all
+    of it. Yields nothing if the command could not be started."""
+    SPAWNS[0] += 1
+    try:
+        process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=stderr,
+                                   universal_newlines=True)
+    except OSError:
+        return
+    try:
+        for line in process.stdout:
+            yield line
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
 def get_ref_loudness():
     """Get default replaygain reference loudness from bs1770gain."""
     buf = run_command("bs1770gain --help", stderr=subprocess.STDOUT)
@@ -105,6 +215,204 @@ def get_ref_loudness():
     return buf.group(1)
 
 
+def read_vint(data, pos, keep_marker=False):
+    """Decode an EBML variable size integer from a bytearray, return (value, next position).
+
+    The value is None for sizes with all value bits set, which means "unknown size"."""
+    if pos >= len(data):
+        raise ValueError("Unexpected end of EBML data")
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8 or pos + length > len(data):
+        raise ValueError("Invalid EBML variable size integer")
+    value = first if keep_marker else first & (mask - 1)
+    unknown = value == mask - 1
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+        unknown = unknown and byte == 0xFF
+    if unknown and not keep_marker:
+        return None, pos + length
+    return value, pos + length
+
+
+def read_uint(data, start, end):
+    """Decode an EBML unsigned integer element's payload."""
+    value = 0
+    for byte in data[start:end]:
+        value = (value << 8) | byte
+    return value
+
+
+def iter_elements(data, start, end):
+    """Yield (element id, payload start, payload end) of the child elements in data[start:end]."""
+    pos = start
+    while pos < end:
+        element_id, pos = read_vint(data, pos, True)
+        size, pos = read_vint(data, pos)
+        if size is None or pos + size > end:
+            raise ValueError("Truncated or unknown size EBML element")
+        yield element_id, pos, pos + size
+        pos += size
+
+
+def encode_id(element_id):
+    """Encode an element ID, which keeps its length marker."""
+    return bytearray(struct.pack(">I", element_id)).lstrip(b"\0")
+
+
+def encode_size(size, length=None):
+    """Encode an EBML element size, with the shortest length if none is given."""
+    if length is None:
+        length = 1
+        while length < 8 and size >= (1 << (7 * length)) - 1:
+            length += 1
+    if length > 8 or size >= (1 << (7 * length)) - 1:
+        raise ValueError("Size does not fit in {} bytes".format(length))
+    return bytearray(struct.pack(">Q", size | (1 << (7 * length)))[8 - length:])
+
+
+def encode_uint(value):
+    return bytearray(struct.pack(">Q", value)).lstrip(b"\0") or bytearray(b"\0")
+
+
+def encode_element(element_id, payload, size_length=None):
+    return encode_id(element_id) + encode_size(len(payload), size_length) + payload
+
+
+def void_element(total):
+    """Return a Void element of exactly total bytes, or None if that is not possible."""
+    for size_length in range(1, 9):
+        size = total - 1 - size_length
+        if 0 <= size < (1 << (7 * size_length)) - 1:
+            return encode_element(EBML_VOID, bytearray(size), size_length)
+    return None
+
+
+def rg_simple_tags(ref_loudness, rg_integrated, rg_range, rg_peak, album=None):
+    """Return the replaygain (name, value) pairs of a track, album is a (gain, peak) pair."""
+    simple_tags = [
+        ("REPLAYGAIN_ALGORITHM", RG_ALGORITHM),
+        ("REPLAYGAIN_REFERENCE_LOUDNESS", ref_loudness),
+        ("REPLAYGAIN_TRACK_GAIN", rg_integrated),
+        ("REPLAYGAIN_TRACK_RANGE", rg_range),
+        ("REPLAYGAIN_TRACK_PEAK", rg_peak),
+    ]
+    if album is not None:
+        simple_tags += [("REPLAYGAIN_ALBUM_GAIN", album[0]), ("REPLAYGAIN_ALBUM_PEAK", album[1])]
+    return simple_tags
+
+
+def album_group(path, regex=None):
+    """Album a file belongs to, the first group (or the match) of regex, else its directory."""
+    if regex is not None:
+        matches = regex.search(path)
+        if matches:
+            return matches.group(1) if matches.groups() else matches.group(0)
+    return os.path.dirname(os.path.abspath(path))
+
+
+def power_to_lufs(power):
+    """Loudness of a mean square K-weighted power."""
+    return -0.691 + 10.0 * math.log10(power) if power > 0 else float("-inf")
+
+
+def biquad_response(b_coeffs, a_coeffs, omega):
+    """Frequency response of a biquad at the angular frequencies omega (radians / sample)."""
+    z_inv = numpy.exp(-1j * omega)
+    return ((b_coeffs[0] + b_coeffs[1] * z_inv + b_coeffs[2] * z_inv ** 2) /
+            (a_coeffs[0] + a_coeffs[1] * z_inv + a_coeffs[2] * z_inv ** 2))
+
+
+def k_weighting_kernel(rate):
+    """
+    FIR approximation of the BS.1770 K-weighting filter (high shelf + high pass) at any sample
+    rate, taken from the biquads' frequency response. Half a second of impulse response is kept,
+    the high pass has decayed by far more than the 0.01 LU the results are rounded to by then.
+    """
+    # Shelving stage, coefficients derived for any rate as in libebur128.
+    k_shelf = math.tan(math.pi * 1681.974450955533 / rate)
+    q_shelf = 0.7071752369554196
+    gain_high = 10.0 ** (3.999843853973347 / 20.0)
+    gain_band = gain_high ** 0.4996667741545416
+    a_shelf = 1.0 + k_shelf / q_shelf + k_shelf ** 2
+    shelf_b = [(gain_high + gain_band * k_shelf / q_shelf + k_shelf ** 2) / a_shelf,
+               2.0 * (k_shelf ** 2 - gain_high) / a_shelf,
+               (gain_high - gain_band * k_shelf / q_shelf + k_shelf ** 2) / a_shelf]
+    shelf_a = [1.0, 2.0 * (k_shelf ** 2 - 1.0) / a_shelf,
+               (1.0 - k_shelf / q_shelf + k_shelf ** 2) / a_shelf]
+    # High pass stage.
+    k_pass = math.tan(math.pi * 38.13547087602444 / rate)
+    q_pass = 0.5003270373238773
+    a_pass = 1.0 + k_pass / q_pass + k_pass ** 2
+    pass_b = [1.0, -2.0, 1.0]
+    pass_a = [1.0, 2.0 * (k_pass ** 2 - 1.0) / a_pass, (1.0 - k_pass / q_pass + k_pass ** 2) / a_pass]
+
+    taps = int(rate) // 2
+    size = 1 << int(math.ceil(math.log(taps * 8, 2)))
+    omega = numpy.linspace(0.0, numpy.pi, size // 2 + 1)
+    response = biquad_response(shelf_b, shelf_a, omega) * biquad_response(pass_b, pass_a, omega)
+    return numpy.fft.irfft(response, size)[:taps]
+
+
+def true_peak_kernel(factor, taps_per_phase=12):
+    """Polyphase interpolation filter (Hann windowed sinc), one row per output phase."""
+    length = factor * taps_per_phase
+    position = numpy.arange(length) - (length - 1) / 2.0
+    kernel = numpy.sinc(position / factor) * numpy.hanning(length)
+    kernel *= factor / kernel.sum()
+    return numpy.array([kernel[phase::factor] for phase in range(factor)])
+
+
+def channel_weights(channels, mask=0):
+    """BS.1770 channel weights, the LFE is ignored and the surround channels get +1.5 dB."""
+    if not mask:
+        mask = DEFAULT_CHANNEL_MASKS.get(channels, 0)
+    positions = [bit for bit in range(32) if mask & (1 << bit)]
+    weights = numpy.ones(channels)
+    for channel, bit in enumerate(positions[:channels]):
+        if bit == WAV_SPEAKER_LFE:
+            weights[channel] = 0.0
+        elif bit in WAV_SPEAKER_SURROUND:
+            weights[channel] = 1.41
+    return weights
+
+
+def gated_loudness(counts, energy, relative_gate=-10.0):
+    """Gated loudness of the blocks in a LoudnessMeter histogram, None if there are none."""
+    total = counts.sum()
+    if not total:
+        return None
+    threshold = power_to_lufs(energy.sum() / total) + relative_gate
+    first = max(0, int(math.floor((threshold - LoudnessMeter.HIST_MIN) / LoudnessMeter.HIST_STEP)))
+    return power_to_lufs(energy[first:].sum() / counts[first:].sum())
+
+
+def loudness_range(counts, energy):
+    """EBU Tech 3342 loudness range of the short-term blocks in a LoudnessMeter histogram."""
+    total = counts.sum()
+    if not total:
+        return 0.0
+    threshold = power_to_lufs(energy.sum() / total) - 20.0
+    first = max(0, int(math.floor((threshold - LoudnessMeter.HIST_MIN) / LoudnessMeter.HIST_STEP)))
+    cumulative = numpy.cumsum(counts[first:])
+    low = numpy.searchsorted(cumulative, 0.10 * cumulative[-1])
+    high = numpy.searchsorted(cumulative, 0.95 * cumulative[-1])
+    return float(high - low) * LoudnessMeter.HIST_STEP
+
+
+def has_rg_tags(info, album=False):
+    """Check if any audio track of a MatroskaInfo has replaygain (and album, if asked) tags."""
+    for track in info.audio_tracks():
+        if track.tags.get("REPLAYGAIN_ALGORITHM") == RG_ALGORITHM and (
+                not album or "REPLAYGAIN_ALBUM_GAIN" in track.tags):
+            return True
+    return False
+
+
 class Log(object):
     def __init__(self, loglevel=20, name="mkvrg"):
         """"""
@@ -116,6 +424,101 @@ class Log(object):
             handler.setLevel(loglevel)
             self.logger.addHandler(handler)
         self.exit = False
+        self.metrics = None
+        self.run_id = ""
+
+    def metric(self, event, stage="", path="", seconds=0.0, bytes_read=0, audio_seconds=0.0,
+               spawns=0, result=""):
+        """
+        Append an event to the --metrics file as a line of JSON, event is "stage" for the time
+        spent in a stage (discover, probe, analyze, tag, verify) or "file" for a processed file.
+        Every line is written with a single append, so the worker processes can share the file.
+        """
+        if not self.metrics:
+            return
+        line = json.dumps(OrderedDict([
+            ("ts", round(time.time(), 6)), ("run", self.run_id), ("event", event),
+            ("stage", stage), ("file", path), ("seconds", round(seconds, 6)),
+            ("bytes", bytes_read), ("audio_seconds", round(audio_seconds, 3)), ("spawns", spawns),
+            ("result", result)]))
+        with open(self.metrics, "a") as handle:
+            handle.write(line + "\n")
+
+    def metrics_summary(self, started, prom=None):
+        """
+        Append the totals of this run per stage and the amount of files per result to the
+        --metrics file, write them to prom in the Prometheus text format if given.
+        """
+        if not self.metrics:
+            return
+        stages = OrderedDict()
+        results = OrderedDict()
+        with open(self.metrics) as handle:
+            for line in handle:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if event.get("run") != self.run_id:
+                    continue
+                if event["event"] == "file":
+                    results[event["result"]] = results.get(event["result"], 0) + 1
+                elif event["event"] == "stage":
+                    total = stages.setdefault(event["stage"], OrderedDict(
+                        [("count", 0), ("seconds", 0.0), ("bytes", 0), ("audio_seconds", 0.0),
+                         ("spawns", 0)]))
+                    total["count"] += 1
+                    for name in ("seconds", "bytes", "audio_seconds", "spawns"):
+                        total[name] += event[name]
+        now = time.time()
+        wall = max(now - started, 1e-6)
+        files = sum(results.values())
+        audio = sum(total["audio_seconds"] for total in stages.values())
+        summary = OrderedDict([
+            ("ts", round(now, 6)), ("run", self.run_id), ("event", "summary"),
+            ("seconds", round(wall, 6)), ("files", files),
+            ("bytes", sum(total["bytes"] for total in stages.values())),
+            ("audio_seconds", round(audio, 3)),
+            ("spawns", sum(total["spawns"] for total in stages.values())),
+            ("files_per_s", round(files / wall, 3)), ("audio_seconds_per_s", round(audio / wall, 3)),
+            ("results", results), ("stages", stages)])
+        with open(self.metrics, "a") as handle:
+            handle.write(json.dumps(summary) + "\n")
+        self.info("Metrics: {} file(s) in {:.1f} seconds, {:.1f} seconds of audio analyzed "
+                  "({:.1f} per second), {:.1f} MiB read, {} program(s) started.".format(
+                      files, wall, audio, audio / wall, summary["bytes"] / 1048576.0,
+                      summary["spawns"]))
+        if prom:
+            self.__write_prom(prom, summary)
+
+    @staticmethod
+    def __write_prom(path, summary):
+        """Write the summary for node_exporter's textfile collector, atomically."""
+        lines = [
+            "# HELP mkvrg_run_seconds Wall time of the last mkvrg run.",
+            "# TYPE mkvrg_run_seconds gauge",
+            "mkvrg_run_seconds {}".format(summary["seconds"]),
+            "# HELP mkvrg_run_timestamp_seconds End time of the last mkvrg run.",
+            "# TYPE mkvrg_run_timestamp_seconds gauge",
+            "mkvrg_run_timestamp_seconds {}".format(summary["ts"]),
+            "# HELP mkvrg_files Files seen by the last mkvrg run, per result.",
+            "# TYPE mkvrg_files gauge",
+        ]
+        for result, count in summary["results"].items():
+            lines.append('mkvrg_files{{result="{}"}} {}'.format(result, count))
+        for name, description in (
+                ("seconds", "Wall time spent per stage by the last mkvrg run, added up over the"
+                            " workers."),
+                ("bytes", "Bytes read per stage by the last mkvrg run."),
+                ("audio_seconds", "Seconds of audio analyzed per stage by the last mkvrg run."),
+                ("spawns", "External programs started per stage by the last mkvrg run.")):
+            lines.append("# HELP mkvrg_stage_{} {}".format(name, description))
+            lines.append("# TYPE mkvrg_stage_{} gauge".format(name))
+            for stage, total in summary["stages"].items():
+                lines.append('mkvrg_stage_{}{{stage="{}"}} {}'.format(name, stage, total[name]))
+        with open(path + ".tmp", "w") as handle:
+            handle.write("\n".join(lines) + "\n")
+        os.rename(path + ".tmp", path)
 
     def set_level(self, loglevel):
         self.logger.setLevel(loglevel)
@@ -146,57 +549,318 @@ class Log(object):
             exit(code)
 
 
-class ThreadMkvrg(object):
+class PoolMkvrg(object):
+    """
+    Process the files with a pool of worker processes, the most expensive files first.
+    The cost of a file is estimated as its size times its amount of audio tracks, so a large file
+    does not end up running alone at the end while the other workers are idle. Files are started
+    as soon as they are discovered, while all the workers are busy up to DISCOVERY_WINDOW files
+    per worker are held back and the most expensive of them is started next. Workers only receive
+    the MatroskaFile they have to process, see Utils.__getstate__.
+    The files of a device are only started while less than its cap are running, see device_cap,
+    so a disk does not seek between several files while the files of other devices wait.
+    With --album all the files are discovered first and the workers only measure them, see
+    AlbumGain.
+    """
+
+    def __init__(self, utils, discovered):
+        self.utils = utils
+        self.album = None
+        self.done = queue.Queue()
+        self.running = 0
+        self.caps = {}
+        self.device_running = {}
+        self.devices = {}
+        # Started before the discovery threads, forking a process running threads is unsafe.
+        self.pool = multiprocessing.Pool(utils.threads)
+        order = itertools.count()
+        window = []
+        try:
+            if utils.album:
+                for matroska_file in discovered:
+                    utils.files[matroska_file.get_path()] = matroska_file
+                self.album = AlbumGain(utils)
+                discovered = self.album.files()
+            for matroska_file in discovered:
+                path = matroska_file.get_path()
+                device = os.stat(path).st_dev
+                if device not in self.caps:
+                    self.caps[device] = device_cap(path, utils.device_jobs, utils.hdd_jobs,
+                                                   utils.threads)
+                heapq.heappush(window, (-matroska_file.cost(), next(order), device, matroska_file))
+                self.__dispatch(window, utils.threads * DISCOVERY_WINDOW)
+            self.__dispatch(window, 0)
+            while self.running:
+                self.__reap(True)
+        finally:
+            self.pool.close()
+            self.pool.join()
+        if self.album:
+            self.album.apply()
+
+    def __dispatch(self, window, limit):
+        """Start the most expensive files of the window whose device is under its cap while a
+        worker is idle, wait for files to finish while the window holds more than limit files."""
+        self.__reap(False)
+        while window:
+            entry = None
+            if self.running < self.utils.threads:
+                entry = min([entry for entry in window if
+                             self.device_running.get(entry[2], 0) < self.caps[entry[2]]] or [None])
+            if entry is None:
+                if len(window) <= limit:
+                    return
+                self.__reap(True)
+                continue
+            window.remove(entry)
+            heapq.heapify(window)
+            _, job, device, matroska_file = entry
+            self.running += 1
+            self.device_running[device] = self.device_running.get(device, 0) + 1
+            self.devices[job] = device
+            self.pool.apply_async(process_work, (matroska_file,),
+                                  callback=lambda result, job=job: self.done.put((job, result)),
+                                  error_callback=lambda error, job=job: self.done.put((job, error)))
+
+    def __reap(self, wait):
+        """Handle the results of the finished files, waiting for one first if wait is set."""
+        while self.running:
+            try:
+                job, result = self.done.get(wait)
+            except queue.Empty:
+                return
+            wait = False
+            self.running -= 1
+            self.device_running[self.devices.pop(job)] -= 1
+            if isinstance(result, Exception):
+                raise result
+            path, measured = result
+            if self.album and measured:
+                self.album.add(path, measured)
+
+
+class Discovery(object):
+    """
+    Iterate over the MatroskaFile of the matroska files found in the paths given on the command
+    line, as soon as they are found. A pool of threads lists one directory at a time with
+    os.scandir, queueing the subdirectories for the other threads, so separate subtrees are
+    walked in parallel. Files are filtered on their extension and size from the directory entry,
+    then on the EBML magic number, before their header is parsed. Files and directories are only
+    handled once, by device and inode, even when a path is given twice or with a directory holding it.
+    """
+
     def __init__(self, utils):
-        threads = utils.threads
-        total_work = len(utils.files)
-        if total_work < threads:
-            threads = total_work
+        self.utils = utils
+        self.found = 0
+        self.seen = set()
+        self.seen_lock = threading.Lock()
+
+    def __iter__(self):
+        started = time.time()
+        tasks = queue.Queue()
+        found = queue.Queue()
+        for path in self.utils.paths:
+            tasks.put((path, os.path.isdir(path)))
+        threads = [threading.Thread(target=self.__walk, args=(tasks, found))
+                   for _ in range(self.utils.threads)]
+        threads.append(threading.Thread(target=self.__finish, args=(tasks, found, len(threads))))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for matroska_file in iter(found.get, None):
+            self.found += 1
+            yield matroska_file
+        self.utils.log.metric("stage", "discover", seconds=time.time() - started)
+
+    @staticmethod
+    def __finish(tasks, found, threads):
+        """Stop the threads and the iteration once every queued path was handled."""
+        tasks.join()
+        for _ in range(threads):
+            tasks.put(None)
+        found.put(None)
+
+    def __first_visit(self, stat):
+        """Return True the first time the file or directory of the stat result is seen."""
+        with self.seen_lock:
+            if (stat.st_dev, stat.st_ino) in self.seen:
+                return False
+            self.seen.add((stat.st_dev, stat.st_ino))
+            return True
 
-        # pylint: disable=E1101
-        queue = multiprocessing.JoinableQueue(threads)
-        # pylint: enable=E1101
+    def __walk(self, tasks, found):
+        for path, is_dir in iter(tasks.get, None):
+            try:
+                if not self.__first_visit(os.stat(path)):
+                    self.utils.log.debug("Path '{}' was already found, skipping it.".format(path))
+                    continue
+                if is_dir:
+                    self.__scan_dir(path, tasks, found)
+                else:
+                    self.__check_file(path, found)
+            except OSError as error:
+                self.utils.log.warning("Could not read path ({}): {}.".format(path, error))
+            finally:
+                tasks.task_done()
+
+    def __scan_dir(self, directory, tasks, found):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as error:
+            self.utils.log.warning("Could not list directory ({}): {}.".format(directory, error))
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    tasks.put((entry.path, True))
+                elif (entry.name.lower().endswith(MATROSKA_EXTENSIONS) and entry.is_file() and
+                      entry.stat().st_size >= self.utils.minsize and
+                      self.__first_visit(entry.stat())):
+                    self.__check_file(entry.path, found)
+            except OSError:
+                continue
 
-        processes = []
-        for i in range(threads):
-            process = multiprocessing.Process(target=process_thread, args=(i, queue, utils))
-            process.start()
-            processes.append(process)
+    def __check_file(self, path, found):
+        started = time.time()
+        try:
+            found.put(MatroskaFile(path=path, utils=self.utils))
+        except ValueError as error:
+            self.utils.log.debug("Path '{}' does not point to a file of interest: {}."
+                                 .format(path, error))
+            self.utils.log.metric("file", path=path, seconds=time.time() - started,
+                                  result="ignored")
+        self.utils.log.metric("stage", "probe", path, time.time() - started)
 
-        iterator = itertools.chain(utils.files.keys(), (None,)*threads)
-        for work in iterator:
-            queue.put(work)
 
-        for process in processes:
-            process.join()
+class AlbumGain(object):
+    """
+    Album gain and peak of groups of files, by default one group per directory.
+    Every measured track comes with its gating block histogram, the album loudness is computed
+    from the merged histograms of all the tracks of a group, so nothing is decoded twice.
+    A group is skipped when all of its files already have album tags, otherwise all of its files
+    are measured and tagged again, since any new track changes the album gain.
+    """
+
+    def __init__(self, utils):
+        self.utils = utils
+        self.groups = OrderedDict()
+        self.measured = {}
+        for matroska_file in utils.files.values():
+            group = album_group(matroska_file.get_path(), utils.album_group)
+            self.groups.setdefault(group, []).append(matroska_file)
+
+    def files(self):
+        """Return the files of the groups which have to be (re)processed."""
+        work = []
+        for group, matroska_files in self.groups.items():
+            if self.utils.verify and not self.utils.force and all(
+                    has_rg_tags(matroska_file.info, True) for matroska_file in matroska_files):
+                self.utils.log.info("Album tags found on all files of (" + group + "), skipping.")
+                continue
+            work.extend(matroska_files)
+        return work
+
+    def add(self, path, measured):
+        self.measured[path] = measured
+
+    def apply(self):
+        """Compute the album gain and peak of every group and tag its files."""
+        for group, matroska_files in self.groups.items():
+            matroska_files = [matroska_file for matroska_file in matroska_files
+                              if matroska_file.get_path() in self.measured]
+            if not matroska_files:
+                continue
+            counts = numpy.zeros(LoudnessMeter.HIST_BINS, numpy.int64)
+            energy = numpy.zeros(LoudnessMeter.HIST_BINS)
+            peak = 0.0
+            for matroska_file in matroska_files:
+                for track in self.measured[matroska_file.get_path()].values():
+                    counts += track["meter"]["block_counts"]
+                    energy += track["meter"]["block_energy"]
+                    peak = max(peak, float(track["peak"]))
+            integrated = gated_loudness(counts, energy)
+            if integrated is None:
+                self.utils.log.error("Could not compute the album gain of (" + group + ").")
+                continue
+            album = ("{:.2f} LU".format(RG2_REFERENCE - integrated), "{:.6f}".format(peak))
+            self.utils.log.info("Album gain " + album[0] + ", peak " + album[1] + " for (" +
+                                group + ").")
+            for matroska_file in matroska_files:
+                started = time.time()
+                tagged = matroska_file.tag_tracks(self.measured[matroska_file.get_path()], album)
+                matroska_file.metric_file(started, "tagged" if tagged else "failed")
 
 
 class CheckArgs(object):
     def __init__(self, utils):
         self.utils = utils
-        args = self.__parse_args()
+        self.__parse_args()
         self.utils.log.exit = self.utils.exit
         self.utils.log.set_level(self.utils.loglevel)
-        self.utils.ref_loudness = get_ref_loudness()
-        if self.utils.ref_loudness == "":
-            self.utils.log("Could not find reference replaygain loudness from bs1770gain.")
+        if self.utils.analyzer == "native":
+            if numpy is None:
+                print("ERROR: The python module 'numpy' is required for --analyzer native.")
+                exit(1)
+            check_binaries(["ffmpeg", "mkvpropedit"])
+            self.utils.ref_loudness = "{:.2f} LUFS".format(RG2_REFERENCE)
+        else:
+            check_binaries(["bs1770gain", "mkvpropedit"])
+            self.utils.ref_loudness = get_ref_loudness()
+        if not self.utils.ref_loudness:
+            self.utils.log.error("Could not find reference replaygain loudness from bs1770gain.")
+            exit(1)
+        if self.utils.album and self.utils.analyzer != "native":
+            self.utils.log.error("Album gain requires --analyzer native.")
+            exit(1)
+        if self.utils.peak_margin is not None and self.utils.analyzer != "native":
+            self.utils.log.error("--peak-margin requires --analyzer native.")
             exit(1)
-
-        for arg in args:
-            if os.path.isdir(arg):
-                self.__check_dir(arg)
-            else:
-                self.__check_file(arg)
 
     def __parse_args(self):
         """Parse command line arguments."""
         parser = ArgumentParser()
         parser.add_argument(
             "-s", "--samplepeak", help="Use the sample peak option instead of true" +
-            " peak for bs1770gain, this is much faster.", action="store_true")
+            " peak, this is much faster.", action="store_true")
+        parser.add_argument(
+            "-p", "--peak-margin", type=float, metavar="DB",
+            help="Only measure the true peak of the one second blocks whose sample peak is within" +
+            " this many dB of full scale, the others keep their sample peak. Requires --analyzer" +
+            " native.")
         parser.add_argument(
-            "-t", "--threads", type=int, help="Amount of threads to use to process files.",
-            default=1)
+            "-a", "--analyzer", choices=["bs1770gain", "native"], default="bs1770gain",
+            help="Program used to measure the loudness, native decodes all the tracks of a file" +
+            " with a single ffmpeg run and measures them in process (requires numpy).")
+        parser.add_argument(
+            "-t", "--threads", type=int,
+            help="Amount of worker processes to use to process files (0 = number of processors).",
+            default=0)
+        parser.add_argument(
+            "-D", "--device-jobs", type=int, default=0,
+            help="Amount of files processed at once from the same device (0 = --hdd-jobs for" +
+            " rotational disks and network shares, --threads otherwise).")
+        parser.add_argument(
+            "-H", "--hdd-jobs", type=int, default=1,
+            help="Amount of files processed at once from a rotational disk or a network share" +
+            " when --device-jobs is 0.")
+        parser.add_argument(
+            "-A", "--album", action="store_true",
+            help="Also write album gain and peak tags, the files of each directory are an album." +
+            " Requires --analyzer native.")
+        parser.add_argument(
+            "-g", "--album-group", type=str, metavar="REGEX",
+            help="Group the files into albums by the first group of this regular expression" +
+            " (or the whole match) on their path instead of by directory, implies --album.")
+        parser.add_argument(
+            "-M", "--metrics", type=str, metavar="PATH",
+            help="Append a line of JSON per event to this file: the time spent in every stage" +
+            " (discover, probe, analyze, tag, verify) of every file with the bytes read, the" +
+            " seconds of audio analyzed and the programs started, the result of every file and" +
+            " a summary of the run.")
+        parser.add_argument(
+            "-P", "--metrics-prom", type=str, metavar="PATH",
+            help="Write the summary of the run to this file in the Prometheus text format," +
+            " for node_exporter's textfile collector.")
         parser.add_argument(
             "-d", "--default", help="Only process the default audio track?", action="store_true")
         parser.add_argument(
@@ -224,6 +888,27 @@ class CheckArgs(object):
         args = parser.parse_args()
         self.utils.loglevel = LOGLEVELS[args.loglevel]
         self.utils.sample_peak = args.samplepeak
+        self.utils.peak_margin = args.peak_margin
+        if self.utils.peak_margin is not None and self.utils.peak_margin < 0:
+            self.utils.log.warning("The --peak-margin must be at least 0")
+            self.utils.log.warning("Setting --peak-margin to 0")
+            self.utils.peak_margin = 0.0
+        self.utils.analyzer = args.analyzer
+        self.utils.metrics = args.metrics
+        self.utils.metrics_prom = args.metrics_prom
+        if self.utils.metrics_prom and not self.utils.metrics:
+            handle, self.utils.metrics = tempfile.mkstemp(suffix=".jsonl")
+            os.close(handle)
+            self.utils.metrics_tmp = True
+        self.utils.log.metrics = self.utils.metrics
+        self.utils.log.run_id = self.utils.run_id
+        self.utils.album = args.album or args.album_group is not None
+        if args.album_group is not None:
+            try:
+                self.utils.album_group = re.compile(args.album_group)
+            except re.error as error:
+                self.utils.log.error("Invalid --album-group regular expression: {}".format(error))
+                exit(1)
         self.utils.default_track = args.default
         self.utils.exit = args.exit
         self.utils.force = args.force
@@ -236,6 +921,17 @@ class CheckArgs(object):
             self.utils.log.warning("Setting --threads to 1")
             self.utils.threads = 1
 
+        self.utils.device_jobs = args.device_jobs
+        if self.utils.device_jobs < 0:
+            self.utils.log.warning("The --device-jobs must be at least 0")
+            self.utils.log.warning("Setting --device-jobs to 0")
+            self.utils.device_jobs = 0
+        self.utils.hdd_jobs = args.hdd_jobs
+        if self.utils.hdd_jobs < 1:
+            self.utils.log.warning("The --hdd-jobs must be at least 1")
+            self.utils.log.warning("Setting --hdd-jobs to 1")
+            self.utils.hdd_jobs = 1
+
         self.utils.minsize = args.minsize
         if self.utils.minsize < 0:
             self.utils.log.error("The --minsize value must be a positive number.")
@@ -243,58 +939,61 @@ class CheckArgs(object):
             self.utils.minsize = 0
 
         self.utils.verify = args.verify
-        if self.utils.verify and not check_binary("mediainfo"):
-            self.utils.log.error(
-                "You enabled the --verify option but you do not have mediainfo installed.")
-            self.utils.log.info("Setting --verify to false.")
-            self.utils.verify = False
 
-        if not args.paths:
+        self.utils.paths = args.paths
+        if not self.utils.paths:
             self.utils.log.info(
                 "No path(s) given, processing current working directory recursively.")
-            return ["."]
-        return args.paths
-
-    def __check_file(self, path):
-        try:
-            # Just some gimmick. Save a tiny bit of memory with 16 byte fixed size hash. Collisions
-            # should be no problem on a sane filesystem, I reckon. (I was bored;)
-            self.utils.files[hashlib.md5(path).digest()] = MatroskaFile(path=path,
-                                                                        utils=self.utils)
-        except ValueError as error:
-            self.utils.log.debug("Path '{}' does not point to a file of interest: {}."
-                                 .format(path, error))
-
-    def __check_dir(self, directory):
-        for rootdir, _, filenames in os.walk(directory):
-            files = fnmatch.filter(filenames, '*.[mM][kK][aAvV]')
-            files.extend(fnmatch.filter(filenames, '*.[mM][kK]3[dD]'))
-            for filename in files:
-                self.__check_file(os.path.join(rootdir, filename))
-
+            self.utils.paths = ["."]
 
 class Utils(object):
     def __init__(self):
         self.opt_exit = ""
-        self.exit = self.minsize = self.threads = 0
-        # self.loglevel = LOGLEVELS["info"]
+        self.exit = self.minsize = self.threads = self.device_jobs = 0
+        self.hdd_jobs = 1
+        self.loglevel = LOGLEVELS["info"]
         self.sample_peak = self.default_track = self.exit = self.force = self.verify = False
-        self.track_list_regex = re.compile(r"Stream\s*#\d+:(\d+).+?Audio")
+        self.analyzer = "bs1770gain"
+        self.peak_margin = None
+        self.album = False
+        self.album_group = None
+        self.metrics = self.metrics_prom = None
+        self.metrics_tmp = False
+        self.run_id = "{}-{}".format(os.getpid(), int(time.time() * 1000000))
         self.rg_integrated_regex = re.compile(r"([-\d.]+\s*LU)\s*$")
         self.rg_range_regex = re.compile(r"([-\d.]+\s*LUFS)\s*$")
         self.rg_peak_regex = re.compile(r"([-\d.]+)\s*$")
+        self.paths = []
         self.files = OrderedDict()
         self.log = None
 
-    def check_tags(self, path, first_check=True):
+    def __getstate__(self):
+        """Leave the file table and the logger out when sending work to a worker process."""
+        state = self.__dict__.copy()
+        state["files"] = OrderedDict()
+        state["log"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.log = Log(self.loglevel)
+        self.log.metrics = self.metrics
+        self.log.run_id = self.run_id
+        self.log.exit = self.exit
+
+    def check_tags(self, path, first_check=True, info=None):
         """Check if matroska file has replaygain tags."""
         if not self.verify:
             return True
         if first_check and self.force:
             self.log.info("Skipping replaygain tags check, --force is on.")
             return True
-        if "ITU-R BS.1770" in run_command("mediainfo " + path +
-                                          ' --Inform="Audio;%REPLAYGAIN_ALGORITHM%"'):
+        if info is None:
+            try:
+                info = MatroskaInfo(path)
+            except (IOError, OSError, ValueError):
+                info = None
+        if info is not None and has_rg_tags(info):
             if first_check:
                 self.log.info("Replaygain tags found in file (" + path + "), skipping.")
                 return False
@@ -328,35 +1027,199 @@ class MakeTmpFile(object):
             os.lseek(self.handle, 0, os.SEEK_SET)
 
 
+class MatroskaTrack(object):
+    def __init__(self, index):
+        """A TrackEntry, index is the ffmpeg / mkvpropedit stream index (starting at 0)."""
+        self.index = index
+        self.number = self.uid = self.type = 0
+        self.default = True
+        self.tags = {}
+
+
+class MatroskaInfo(object):
+    """
+    Minimal Matroska reader for the track list and the existing tags of a file.
+    Only the EBML header, the SeekHead(s) and the Tracks and Tags elements are read, the SeekHead
+    is followed to find elements placed after the clusters, so this is a few KB for most files.
+    A ValueError is raised if the file is not Matroska.
+    """
+
+    # The Tracks and Tags are read in memory, refuse anything unreasonably large.
+    MAX_ELEMENT_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.tracks = []
+        self.tags = {}
+        self.tags_elements = []
+        self.duration = None
+        self.segment_start = self.segment_size_length = 0
+        self.segment_end = None
+        self.__handle = open(path, "rb")
+        try:
+            self.__read_segment()
+        finally:
+            self.__handle.close()
+            self.__handle = None
+        for track in self.tracks:
+            track.tags = self.tags.get(track.uid, {})
+
+    def audio_tracks(self):
+        return [track for track in self.tracks if track.type == MKV_TRACKTYPE_AUDIO]
+
+    def __read(self, pos, size):
+        self.__handle.seek(pos)
+        data = bytearray(self.__handle.read(size))
+        if len(data) != size:
+            raise ValueError("Unexpected end of file")
+        return data
+
+    def __element_at(self, pos):
+        """Return (element id, payload size, payload position) of the element at pos."""
+        self.__handle.seek(pos)
+        data = bytearray(self.__handle.read(12))
+        element_id, offset = read_vint(data, 0, True)
+        size, offset = read_vint(data, offset)
+        return element_id, size, pos + offset
+
+    def __read_segment(self):
+        element_id, size, pos = self.__element_at(0)
+        if element_id != EBML_HEADER or size is None:
+            raise ValueError("No EBML header")
+        header = self.__read(pos, size)
+        doctype = None
+        for child_id, start, end in iter_elements(header, 0, size):
+            if child_id == EBML_DOCTYPE:
+                doctype = bytes(header[start:end]).rstrip(b"\0")
+        if doctype not in (b"matroska", b"webm"):
+            raise ValueError("EBML document is not matroska")
+
+        pos += size
+        element_id, size, self.segment_start = self.__element_at(pos)
+        if element_id != MKV_SEGMENT:
+            raise ValueError("No matroska segment")
+        self.segment_size_length = self.segment_start - pos - len(encode_id(MKV_SEGMENT))
+        self.segment_end = segment_end = None if size is None else self.segment_start + size
+
+        # Walk the level 1 elements up to the first cluster, the SeekHead(s) tell where the rest is.
+        pending = []
+        visited = set()
+        pos = self.segment_start
+        while segment_end is None or pos < segment_end:
+            try:
+                element_id, size, data_pos = self.__element_at(pos)
+            except ValueError:
+                break
+            if element_id == MKV_CLUSTER or size is None:
+                break
+            pending.append((element_id, pos))
+            pos = data_pos + size
+
+        while pending:
+            element_id, pos = pending.pop(0)
+            if pos in visited or element_id not in (MKV_SEEKHEAD, MKV_INFO, MKV_TRACKS, MKV_TAGS):
+                continue
+            visited.add(pos)
+            real_id, size, data_pos = self.__element_at(pos)
+            if real_id != element_id or size is None or size > self.MAX_ELEMENT_SIZE:
+                continue
+            data = self.__read(data_pos, size)
+            if element_id == MKV_SEEKHEAD:
+                pending.extend(self.__parse_seekhead(data))
+            elif element_id == MKV_INFO and self.duration is None:
+                self.__parse_info(data)
+            elif element_id == MKV_TRACKS and not self.tracks:
+                self.__parse_tracks(data)
+            elif element_id == MKV_TAGS:
+                self.tags_elements.append((pos, data_pos, size))
+                self.__parse_tags(data)
+
+    def __parse_info(self, data):
+        """Read the duration of the segment in seconds."""
+        timecode_scale = 1000000
+        duration = None
+        for child_id, start, end in iter_elements(data, 0, len(data)):
+            if child_id == MKV_TIMECODESCALE:
+                timecode_scale = read_uint(data, start, end)
+            elif child_id == MKV_DURATION and end - start in (4, 8):
+                duration = struct.unpack(">f" if end - start == 4 else ">d",
+                                         bytes(data[start:end]))[0]
+        if duration is not None:
+            self.duration = duration * timecode_scale / 1e9
+
+    def __parse_seekhead(self, data):
+        seeks = []
+        for seek_id, start, end in iter_elements(data, 0, len(data)):
+            if seek_id != MKV_SEEK:
+                continue
+            target = position = None
+            for child_id, child_start, child_end in iter_elements(data, start, end):
+                if child_id == MKV_SEEKID:
+                    target = read_uint(data, child_start, child_end)
+                elif child_id == MKV_SEEKPOSITION:
+                    position = read_uint(data, child_start, child_end)
+            if target is not None and position is not None:
+                seeks.append((target, self.segment_start + position))
+        return seeks
+
+    def __parse_tracks(self, data):
+        for entry_id, start, end in iter_elements(data, 0, len(data)):
+            if entry_id != MKV_TRACKENTRY:
+                continue
+            track = MatroskaTrack(len(self.tracks))
+            for child_id, child_start, child_end in iter_elements(data, start, end):
+                if child_id == MKV_TRACKNUMBER:
+                    track.number = read_uint(data, child_start, child_end)
+                elif child_id == MKV_TRACKUID:
+                    track.uid = read_uint(data, child_start, child_end)
+                elif child_id == MKV_TRACKTYPE:
+                    track.type = read_uint(data, child_start, child_end)
+                elif child_id == MKV_FLAGDEFAULT:
+                    track.default = read_uint(data, child_start, child_end) == 1
+            self.tracks.append(track)
+
+    def __parse_tags(self, data):
+        for tag_id, start, end in iter_elements(data, 0, len(data)):
+            if tag_id != MKV_TAG:
+                continue
+            uids = []
+            simple_tags = {}
+            for child_id, child_start, child_end in iter_elements(data, start, end):
+                if child_id == MKV_TARGETS:
+                    for target_id, target_start, target_end in iter_elements(data, child_start,
+                                                                             child_end):
+                        if target_id == MKV_TAGTRACKUID:
+                            uids.append(read_uint(data, target_start, target_end))
+                elif child_id == MKV_SIMPLETAG:
+                    name = value = None
+                    for simple_id, simple_start, simple_end in iter_elements(data, child_start,
+                                                                             child_end):
+                        if simple_id == MKV_TAGNAME:
+                            name = bytes(data[simple_start:simple_end]).decode("utf-8", "replace")
+                        elif simple_id == MKV_TAGSTRING:
+                            value = bytes(data[simple_start:simple_end]).decode("utf-8", "replace")
+                    if name:
+                        simple_tags[name] = value
+            # A Tag without TagTrackUID (or with 0) applies to the whole segment.
+            for uid in uids or [0]:
+                self.tags.setdefault(uid, {}).update(simple_tags)
+
+
 class XmlUtils(object):
     def __init__(self, ref_loudness):
         """"""
         self.ref_loudness = ref_loudness
         self.tags = self.tag = None
 
-    def set_rg_head(self):
+    def set_rg_tags(self, simple_tags):
+        """Build the XML of one track's tags from (name, value) pairs, see rg_simple_tags."""
         self.tags = xml.Element("Tags")
         self.tag = xml.SubElement(self.tags, "Tag")
         xml.SubElement(self.tag, "Targets")
-        simple = xml.SubElement(self.tag, "Simple")
-        xml.SubElement(simple, "Name").text = "REPLAYGAIN_ALGORITHM"
-        xml.SubElement(simple, "String").text = "ITU-R BS.1770"
-        simple = xml.SubElement(self.tag, "Simple")
-        xml.SubElement(simple, "Name").text = "REPLAYGAIN_REFERENCE_LOUDNESS"
-        xml.SubElement(simple, "String").text = self.ref_loudness
-
-    def set_rg_tags(self, rg_integrated, rg_range, rg_peak):
-        if self.tags is None or self.tag is not None:
-            self.set_rg_head()
-        simple = xml.SubElement(self.tag, "Simple")
-        xml.SubElement(simple, "Name").text = "REPLAYGAIN_TRACK_GAIN"
-        xml.SubElement(simple, "String").text = rg_integrated
-        simple = xml.SubElement(self.tag, "Simple")
-        xml.SubElement(simple, "Name").text = "REPLAYGAIN_TRACK_RANGE"
-        xml.SubElement(simple, "String").text = rg_range
-        simple = xml.SubElement(self.tag, "Simple")
-        xml.SubElement(simple, "Name").text = "REPLAYGAIN_TRACK_PEAK"
-        xml.SubElement(simple, "String").text = rg_peak
+        for name, value in simple_tags:
+            simple = xml.SubElement(self.tag, "Simple")
+            xml.SubElement(simple, "Name").text = name
+            xml.SubElement(simple, "String").text = value
 
     def write_rg_xml(self, path):
         if self.tag is None or self.tags is None:
@@ -365,6 +1228,355 @@ class XmlUtils(object):
         self.tag = self.tags = None
 
 
+class MatroskaTagWriter(object):
+    """
+    Writes track tags straight into the existing Tags element of a Matroska file, without
+    mkvpropedit. The other tags are kept, previous tags with the same names on the written tracks
+    are replaced. The new Tags element goes over the old one and the Void elements following it,
+    leftover space is turned into a new Void, or when the Tags element is the last thing in the
+    file it is simply rewritten there. write() returns False without touching the file when there
+    is no Tags element or not enough room, the caller should then fall back to mkvpropedit.
+    """
+
+    def __init__(self, info):
+        self.info = info
+
+    def write(self, track_tags):
+        """Write {stream index: [(name, value), ...]} to the file of self.info."""
+        info = self.info
+        if len(info.tags_elements) != 1:
+            return False
+        uid_tags = {}
+        for index, simple_tags in track_tags.items():
+            if int(index) >= len(info.tracks) or not info.tracks[int(index)].uid:
+                return False
+            uid_tags[info.tracks[int(index)].uid] = simple_tags
+        pos, data_pos, size = info.tags_elements[0]
+        with open(info.path, "r+b") as handle:
+            handle.seek(data_pos)
+            data = bytearray(handle.read(size))
+            if len(data) != size:
+                return False
+            payload = self.__rebuild(data, uid_tags)
+            file_size = os.fstat(handle.fileno()).st_size
+            end = data_pos + size
+            while end < file_size:
+                handle.seek(end)
+                header = bytearray(handle.read(12))
+                try:
+                    element_id, offset = read_vint(header, 0, True)
+                    void_size, offset = read_vint(header, offset)
+                except ValueError:
+                    break
+                if element_id != EBML_VOID or void_size is None:
+                    break
+                end += offset + void_size
+            at_end = end >= file_size and info.segment_end in (None, file_size)
+            element = self.__fit(payload, end - pos)
+            if element is None and at_end:
+                element = encode_element(MKV_TAGS, payload)
+            if element is None:
+                return False
+            new_end = pos + len(element)
+            if at_end and info.segment_end is not None and new_end != file_size:
+                try:
+                    segment_size = encode_size(new_end - info.segment_start,
+                                               info.segment_size_length)
+                except ValueError:
+                    return False
+                handle.seek(info.segment_start - info.segment_size_length)
+                handle.write(segment_size)
+            handle.seek(pos)
+            handle.write(element)
+            if at_end and new_end != file_size:
+                handle.truncate(new_end)
+            handle.flush()
+            os.fsync(handle.fileno())
+        return True
+
+    @staticmethod
+    def __rebuild(data, uid_tags):
+        """Return the new Tags payload, with the tags in uid_tags replacing the old ones."""
+        children = list(iter_elements(data, 0, len(data)))
+        payload = bytearray()
+        for element_id, start, end in children:
+            if element_id in (EBML_CRC32, EBML_VOID):
+                continue
+            if element_id != MKV_TAG:
+                payload += encode_element(element_id, data[start:end])
+                continue
+            uids = []
+            targets = bytearray()
+            simple_tags = []
+            for child_id, child_start, child_end in iter_elements(data, start, end):
+                if child_id == MKV_TARGETS:
+                    targets = encode_element(child_id, data[child_start:child_end])
+                    for target_id, target_start, target_end in iter_elements(data, child_start,
+                                                                             child_end):
+                        if target_id == MKV_TAGTRACKUID:
+                            uids.append(read_uint(data, target_start, target_end))
+                elif child_id == MKV_SIMPLETAG:
+                    name = None
+                    for simple_id, simple_start, simple_end in iter_elements(data, child_start,
+                                                                             child_end):
+                        if simple_id == MKV_TAGNAME:
+                            name = bytes(data[simple_start:simple_end]).decode("utf-8", "replace")
+                    simple_tags.append((name, encode_element(child_id,
+                                                             data[child_start:child_end])))
+            if not uids or any(uid not in uid_tags for uid in uids):
+                payload += encode_element(element_id, data[start:end])
+                continue
+            replaced = set()
+            for uid in uids:
+                replaced.update(name for name, _ in uid_tags[uid])
+            kept = [raw for name, raw in simple_tags if name not in replaced]
+            if kept:
+                payload += encode_element(MKV_TAG, targets + b"".join(kept))
+        for uid, tags in uid_tags.items():
+            tag = encode_element(MKV_TARGETS, encode_element(MKV_TAGTRACKUID, encode_uint(uid)))
+            for name, value in tags:
+                tag += encode_element(MKV_SIMPLETAG,
+                                      encode_element(MKV_TAGNAME, name.encode("utf-8")) +
+                                      encode_element(MKV_TAGSTRING, value.encode("utf-8")))
+            payload += encode_element(MKV_TAG, tag)
+        if children and children[0][0] == EBML_CRC32:
+            crc = struct.pack("<I", zlib.crc32(bytes(payload)) & 0xFFFFFFFF)
+            payload = encode_element(EBML_CRC32, crc) + payload
+        return payload
+
+    @staticmethod
+    def __fit(payload, available):
+        """Return the Tags element, padded with a Void to exactly available bytes, or None."""
+        for size_length in range(1, 9):
+            try:
+                header = encode_id(MKV_TAGS) + encode_size(len(payload), size_length)
+            except ValueError:
+                continue
+            rest = available - len(header) - len(payload)
+            if rest == 0:
+                return header + payload
+            void = void_element(rest)
+            if void is not None:
+                return header + payload + void
+        return None
+
+
+class LoudnessMeter(object):
+    """
+    ITU-R BS.1770-4 / EBU R128 meter, fed with blocks of float samples (frames x channels).
+    Integrated loudness, loudness range, sample peak and true peak (oversampled to at least 192 kHz)
+    are all measured in the same pass. Memory use does not grow with the track length, the 400 ms
+    gating blocks and the 3 s short-term blocks only end up in fixed size loudness histograms.
+    Only the blocks whose sample peak reaches true_peak_from (an amplitude) are oversampled, the
+    true peak of quieter blocks does not matter, with None no block is.
+    """
+
+    HIST_MIN = -70.0
+    HIST_STEP = 0.01
+    HIST_BINS = 8000
+
+    def __init__(self, rate, channels, channel_mask=0, true_peak_from=0.0):
+        self.rate = rate
+        self.channels = channels
+        self.weights = channel_weights(channels, channel_mask)
+        self.kernel = k_weighting_kernel(rate)
+        self.kernel_spectra = {}
+        self.tail = numpy.zeros((len(self.kernel) - 1, channels))
+        self.sub_block = int(round(rate / 10.0))
+        self.pending = numpy.zeros((0, channels))
+        self.powers = numpy.zeros(0)
+        self.sub_blocks = 0
+        self.block_counts = numpy.zeros(self.HIST_BINS, numpy.int64)
+        self.block_energy = numpy.zeros(self.HIST_BINS)
+        self.short_counts = numpy.zeros(self.HIST_BINS, numpy.int64)
+        self.short_energy = numpy.zeros(self.HIST_BINS)
+        self.sample_peak = self.true_peak = 0.0
+        self.oversample = 4 if rate < 96000 else 2 if rate < 192000 else 1
+        self.interpolator = true_peak_kernel(self.oversample)
+        self.history = numpy.zeros((self.interpolator.shape[1] - 1, channels))
+        self.true_peak_from = true_peak_from
+
+    def feed(self, samples):
+        samples = numpy.asarray(samples, dtype=numpy.float64).reshape(-1, self.channels)
+        if not len(samples):
+            return
+        block_peak = float(numpy.abs(samples).max())
+        self.sample_peak = max(self.sample_peak, block_peak)
+        # The first interpolated samples of a block depend on the end of the previous one.
+        if self.oversample > 1 and self.true_peak_from is not None and \
+                max(block_peak, float(numpy.abs(self.history).max(initial=0.0))) >= self.true_peak_from:
+            self.__measure_true_peak(samples)
+        elif len(self.history):
+            # The next block is interpolated with the end of this one.
+            self.history = numpy.concatenate((self.history, samples))[-len(self.history):]
+        self.__gate(self.__filter(samples))
+
+    def result(self):
+        """
+        Return the measurements, integrated is None for tracks shorter than 400 ms. The gating
+        block histogram is included, merging the histograms of several tracks gives their
+        combined (album) loudness without decoding them again.
+        """
+        integrated = gated_loudness(self.block_counts, self.block_energy)
+        return {
+            "block_counts": self.block_counts,
+            "block_energy": self.block_energy,
+            "integrated": integrated,
+            "range": loudness_range(self.short_counts, self.short_energy),
+            "sample_peak": self.sample_peak,
+            "true_peak": max(self.true_peak, self.sample_peak),
+            "gain": None if integrated is None else RG2_REFERENCE - integrated,
+        }
+
+    def __filter(self, samples):
+        """K-weight a block with an FFT overlap-add convolution, carrying the tail over."""
+        count = len(samples)
+        size = 1 << int(math.ceil(math.log(count + len(self.kernel) - 1, 2)))
+        if size not in self.kernel_spectra:
+            self.kernel_spectra[size] = numpy.fft.rfft(self.kernel, size)[:, None]
+        spectrum = numpy.fft.rfft(samples, size, axis=0) * self.kernel_spectra[size]
+        filtered = numpy.fft.irfft(spectrum, size, axis=0)[:count + len(self.kernel) - 1]
+        filtered[:len(self.tail)] += self.tail
+        self.tail = filtered[count:].copy()
+        return filtered[:count]
+
+    def __gate(self, filtered):
+        """Split in 100 ms sub-blocks and add the 400 ms and 3 s windows ending on each."""
+        data = numpy.concatenate((self.pending, filtered))
+        count = len(data) // self.sub_block
+        self.pending = data[count * self.sub_block:]
+        if not count:
+            return
+        squares = (data[:count * self.sub_block] ** 2).reshape(count, self.sub_block,
+                                                                self.channels).mean(axis=1)
+        history = numpy.concatenate((self.powers, squares.dot(self.weights)))
+        cumulative = numpy.concatenate(([0.0], numpy.cumsum(history)))
+        ends = numpy.arange(len(self.powers), len(history)) + 1
+        numbers = self.sub_blocks + numpy.arange(count)
+        for length, counts, energy in ((4, self.block_counts, self.block_energy),
+                                       (30, self.short_counts, self.short_energy)):
+            valid = numbers >= length - 1
+            if valid.any():
+                window = ends[valid]
+                self.__add(counts, energy, (cumulative[window] - cumulative[window - length]) /
+                           length)
+        self.sub_blocks += count
+        self.powers = history[-29:]
+
+    def __add(self, counts, energy, powers):
+        """Add block powers above the -70 LUFS absolute gate to a histogram."""
+        loudness = -0.691 + 10.0 * numpy.log10(numpy.maximum(powers, 1e-20))
+        keep = loudness > self.HIST_MIN
+        bins = numpy.clip(((loudness[keep] - self.HIST_MIN) / self.HIST_STEP).astype(int), 0,
+                          self.HIST_BINS - 1)
+        counts += numpy.bincount(bins, minlength=self.HIST_BINS)
+        energy += numpy.bincount(bins, weights=powers[keep], minlength=self.HIST_BINS)
+
+    def __measure_true_peak(self, samples):
+        data = numpy.concatenate((self.history, samples))
+        for channel in range(self.channels):
+            for phase in self.interpolator:
+                peak = numpy.abs(numpy.convolve(data[:, channel], phase, "valid")).max()
+                self.true_peak = max(self.true_peak, float(peak))
+        self.history = data[len(data) - len(self.history):]
+
+
+def read_wav_header(handle):
+    """Read a WAV header up to the data chunk, return (rate, channels, channel mask)."""
+    riff = handle.read(12)
+    if len(riff) != 12 or riff[:4] != b"RIFF" or riff[8:] != b"WAVE":
+        raise ValueError("Not a WAV stream")
+    rate = channels = mask = None
+    while True:
+        chunk = handle.read(8)
+        if len(chunk) != 8:
+            raise ValueError("No data chunk in WAV stream")
+        chunk_id, size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+        if chunk_id == b"data":
+            break
+        data = handle.read(size + (size & 1))
+        if chunk_id == b"fmt ":
+            channels, rate = struct.unpack("<HI", data[2:8])
+            if len(data) >= 24 and struct.unpack("<H", data[:2])[0] == 0xFFFE:
+                mask = struct.unpack("<I", data[20:24])[0]
+    if not rate or not channels:
+        raise ValueError("No fmt chunk in WAV stream")
+    return rate, channels, mask or 0
+
+
+class NativeAnalyzer(object):
+    """
+    Measures the audio tracks of a file with LoudnessMeter. A single ffmpeg run decodes all the
+    tracks, each one is written as 32 bit float WAV to its own pipe and read by its own thread.
+    The file is opened here with a sequential access hint, so the kernel reads ahead further,
+    and given to ffmpeg on its standard input.
+    """
+
+    def __init__(self, path, ffmpeg="ffmpeg", true_peak_from=0.0):
+        self.path = path
+        self.ffmpeg = ffmpeg
+        self.true_peak_from = true_peak_from
+
+    def analyze(self, stream_indexes):
+        """Return {stream index: LoudnessMeter.result() or None on failure}."""
+        results = dict((index, None) for index in stream_indexes)
+        try:
+            source = open(self.path, "rb")
+        except (IOError, OSError):
+            return results
+        with source:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            return self.__analyze(stream_indexes, source, results)
+
+    def __analyze(self, stream_indexes, source, results):
+        pipes = [os.pipe() for _ in stream_indexes]
+        command = [self.ffmpeg, "-nostdin", "-hide_banner", "-loglevel", "error", "-i", "pipe:0"]
+        for index, (_, write_fd) in zip(stream_indexes, pipes):
+            command += ["-map", "0:" + str(index), "-map_metadata", "-1", "-fflags", "+bitexact",
+                        "-c:a", "pcm_f32le", "-f", "wav", "pipe:" + str(write_fd)]
+        SPAWNS[0] += 1
+        try:
+            process = subprocess.Popen(command, stdin=source, pass_fds=[fds[1] for fds in pipes])
+        except OSError:
+            for read_fd, write_fd in pipes:
+                os.close(read_fd)
+                os.close(write_fd)
+            return results
+        threads = []
+        for index, (read_fd, write_fd) in zip(stream_indexes, pipes):
+            os.close(write_fd)
+            thread = threading.Thread(target=self.__measure,
+                                      args=(index, read_fd, results, self.true_peak_from))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if process.wait() != 0:
+            return dict((index, None) for index in stream_indexes)
+        return results
+
+    @staticmethod
+    def __measure(index, read_fd, results, true_peak_from):
+        with os.fdopen(read_fd, "rb") as handle:
+            try:
+                rate, channels, mask = read_wav_header(handle)
+            except ValueError:
+                return
+            meter = LoudnessMeter(rate, channels, mask, true_peak_from)
+            frame = 4 * channels
+            leftover = b""
+            while True:
+                data = handle.read(rate * frame)
+                if not data:
+                    break
+                data = leftover + data
+                usable = len(data) - len(data) % frame
+                leftover = data[usable:]
+                meter.feed(numpy.frombuffer(data[:usable], dtype="<f4"))
+        results[index] = meter.result()
+
+
 class Mkvrg(object):
     def __init__(self, utils, thread=0, **kwds):
         # Strictly, len(**kwds) should now be 0, but if not we might have forgot something.
@@ -374,31 +1586,18 @@ class Mkvrg(object):
         self.track_count = 0
         self.track = {}
         self.rg_integrated = self.rg_range = self.rg_peak = ""
-        self.mk_tmp = MakeTmpFile()
-        self.tmp_file = self.mk_tmp.path
         self.tracks = {}
         self.set_thread(thread)
 
-    def get_tracks(self, path):
-        """Get audio track numbers from bs1770gain"""
-        buf = StringIO(run_command("bs1770gain -l " + path, subprocess.STDOUT,
-                                   universal_newlines=True))
-        i = 0
-        for line in buf:
-            if "Audio" in line and "Stream" in line:
-                i += 1
-                if self.utils.default_track is True and "default" not in line:
-                    self.utils.log.info(
-                        self.s_thread + "Skipping non default audio track " + str(i) +
-                        ", you enabled --default (" + path + ")")
-                    continue
-                matches = self.utils.track_list_regex.search(line)
-                if not matches:
-                    self.utils.log.warning(
-                        self.s_thread + "Problem finding track number for track " + str(i) +
-                        " (" + path + ")")
-                    continue
-                self.tracks[i] = matches.group(1)
+    def get_tracks(self, info):
+        """Get audio track numbers from the Tracks element of a MatroskaInfo."""
+        for i, track in enumerate(info.audio_tracks(), 1):
+            if self.utils.default_track is True and not track.default:
+                self.utils.log.info(
+                    self.s_thread + "Skipping non default audio track " + str(i) +
+                    ", you enabled --default (" + info.path + ")")
+                continue
+            self.tracks[i] = str(track.index)
 
     def set_thread(self, num_thread):
         self.__thread = num_thread
@@ -411,6 +1610,8 @@ class MkxFile(Mkvrg):
             self.__path = path
         else:
             raise ValueError("Path '{}' does not point to a file".format(path))
+        self.info = None
+        self.metric_totals = [0, 0.0, 0]
         # !!! Don't be tempted to call
         # super(self.__class__, self).__init__(utils), it is not
         # quite the same!!! Looks like some level of redundancy is left in Python 2.7 at least.
@@ -419,6 +1620,10 @@ class MkxFile(Mkvrg):
     def get_path(self):
         return self.__path
 
+    def cost(self):
+        """Estimated processing cost, decoding time grows with file size and amount of tracks."""
+        return os.path.getsize(self.get_path()) * max(1, len(self.tracks))
+
     def ismatroska(self):
         """Check if file is an actual matroska file and is of size 'minsize'"""
         path = self.__path
@@ -426,37 +1631,16 @@ class MkxFile(Mkvrg):
         if self.utils.minsize > 0 and os.path.getsize(path) < self.utils.minsize:
             self.utils.log.info("The file is smaller than your --minsize setting, skipping.")
             return False
-        handle = open(path)
-        data = handle.read(64)
-        handle.close()
-        if not (data.startswith("\x1a\x45\xdf\xa3") and "matroska" in data):
-            self.utils.log.debug("File does not seem to contain Matroska data.")
+        if not has_ebml_magic(path):
+            self.utils.log.debug("File does not start with the EBML magic number.")
+            return False
+        try:
+            self.info = MatroskaInfo(path)
+        except (IOError, OSError, ValueError) as error:
+            self.utils.log.debug("File does not seem to contain Matroska data: {}.".format(error))
             return False
         return True
 
-    def hasrgtags(self, path, first_check=True):
-        """Check if matroska file has replaygain tags."""
-        if not self.utils.verify:
-            return True
-        if first_check and self.utils.force:
-            self.utils.log.info("Skipping replaygain tags check, --force is on.")
-            return True
-        if "ITU-R BS.1770" in run_command("mediainfo " + path +
-                                          ' --Inform="Audio;%REPLAYGAIN_ALGORITHM%"'):
-            if first_check:
-                self.utils.log.info("Replaygain tags found in file (" + path + "), skipping.")
-                return False
-            return True
-        if first_check:
-            self.utils.log.info("No replaygain tags found in file (" + path + ") continuing.")
-            return True
-
-        self.utils.log.error(
-            "No replaygain tags were found in file (" +
-            path + ") after applying with mkvpropedit.")
-        return False
-
-
 class MatroskaFile(MkxFile):
     """
     Objects of this class are guaranteed to be of file type matroska AND to have audio tracks.
@@ -477,24 +1661,21 @@ class MatroskaFile(MkxFile):
             raise ValueError("No audio")
 
     def __get_bs1770gain_info(self, trackid):
-        buffer_ = StringIO(
-            run_command(
-                "bs1770gain --audio {trackid} -r {opt_peak_algo} {path}"
-                .format(
-                    trackid=trackid,
-                    opt_peak_algo="-p " if self.utils.sample_peak else "-t ",
-                    path=self.get_path()
-                ),
-                subprocess.STDOUT, universal_newlines=True
-            )
+        lines = iter_command(
+            "bs1770gain --audio {trackid} -r {opt_peak_algo} {path}"
+            .format(
+                trackid=trackid,
+                opt_peak_algo="-p " if self.utils.sample_peak else "-t ",
+                path=self.get_path()
+            ),
+            subprocess.STDOUT
         )
-        if not buffer_:
-            self.utils.log.error(
-                self.s_thread + "Problem running bs1770gain. (" + self.get_path() + ")")
-            return False
 
+        # The output is parsed as it is written, only the track summary is kept.
         self.rg_integrated = self.rg_range = self.rg_peak = ""
-        for line in buffer_:
+        output = False
+        for line in lines:
+            output = True
             if "ALBUM" in line:
                 break
             elif "integrated" in line and self.rg_integrated == "":
@@ -512,6 +1693,11 @@ class MatroskaFile(MkxFile):
                 if not matches:
                     break
                 self.rg_peak = matches.group(1)
+        lines.close()
+        if not output:
+            self.utils.log.error(
+                self.s_thread + "Problem running bs1770gain. (" + self.get_path() + ")")
+            return False
         if not self.rg_integrated or not self.rg_peak or not self.rg_range:
             self.utils.log.error(
                 self.s_thread + "Could not find replaygain info from bs1770gain. (" +
@@ -520,51 +1706,148 @@ class MatroskaFile(MkxFile):
 
         return True
 
-    def __process_tracks(self):
+    def __get_native_info(self, result):
+        if not result or result["integrated"] is None:
+            self.utils.log.error(
+                self.s_thread + "Could not measure the loudness of a track. (" +
+                self.get_path() + ")")
+            return False
+        self.rg_integrated = "{:.2f} LU".format(result["gain"])
+        self.rg_range = "{:.2f} LU".format(result["range"])
+        self.rg_peak = "{:.6f}".format(
+            result["sample_peak"] if self.utils.sample_peak else result["true_peak"])
+        return True
+
+    def metric_stage(self, stage, started, spawns_before, bytes_read=0, audio_seconds=0.0):
+        """Log the metrics of a stage of this file, and add them up for metric_file."""
+        spawns = SPAWNS[0] - spawns_before
+        self.metric_totals = [self.metric_totals[0] + bytes_read,
+                              self.metric_totals[1] + audio_seconds, self.metric_totals[2] + spawns]
+        self.utils.log.metric("stage", stage, self.get_path(), time.time() - started, bytes_read,
+                              audio_seconds, spawns)
+
+    def metric_file(self, started, result):
+        """Log the metrics of this file, the totals of its stages since the last call."""
+        self.utils.log.metric("file", "", self.get_path(), time.time() - started,
+                              self.metric_totals[0], self.metric_totals[1],
+                              self.metric_totals[2], result)
+        self.metric_totals = [0, 0.0, 0]
+
+    def measure_tracks(self):
+        """Measure the audio tracks, return {trackid: {"gain", "range", "peak", "meter"}}."""
+        started, spawns_before = time.time(), SPAWNS[0]
+        measured = self.__measure_tracks()
+        # Every bs1770gain or ffmpeg run reads the whole file.
+        self.metric_stage("analyze", started, spawns_before,
+                          (SPAWNS[0] - spawns_before) * os.path.getsize(self.get_path()),
+                          (self.info.duration or 0.0) * len(measured))
+        return measured
+
+    def __measure_tracks(self):
+        measured = OrderedDict()
         if not self.tracks:
             self.utils.log.error(
                 self.s_thread + "No audio tracks found in file (" + self.get_path() + ")")
-            return False
+            return measured
+        results = {}
+        if self.utils.analyzer == "native":
+            # The true peak is not needed with --samplepeak.
+            true_peak_from = None if self.utils.sample_peak else 0.0
+            if self.utils.peak_margin is not None and not self.utils.sample_peak:
+                true_peak_from = 10.0 ** (-self.utils.peak_margin / 20.0)
+            results = NativeAnalyzer(self.get_path(), true_peak_from=true_peak_from).analyze(
+                list(self.tracks.values()))
         for trackid in self.tracks.values():
-            if not self.__get_bs1770gain_info(trackid):
-                continue
-            if not self.__write_xml_file(self.get_path()):
+            if self.utils.analyzer == "native":
+                if not self.__get_native_info(results[trackid]):
+                    continue
+            elif not self.__get_bs1770gain_info(trackid):
                 continue
-            self.__apply_tags(trackid, self.get_path())
-        self.utils.check_tags(self.get_path(), False)
-
-    def __write_xml_file(self, path):
-        """Write XML file with tags to temp file, for mkvpropedit."""
-        self.mk_tmp.clear()
-        self.xml_utils.set_rg_head()
-        self.xml_utils.set_rg_tags(self.rg_integrated, self.rg_range, self.rg_peak)
-        self.xml_utils.write_rg_xml(self.tmp_file)
-        if os.path.getsize(self.tmp_file) == 0:
+            measured[trackid] = {"gain": self.rg_integrated, "range": self.rg_range,
+                                 "peak": self.rg_peak, "meter": results.get(trackid)}
+        return measured
+
+    def tag_tracks(self, measured, album=None):
+        """Apply the tags of the measured tracks, album is an optional (gain, peak) pair."""
+        track_tags = OrderedDict()
+        for trackid, track in measured.items():
+            track_tags[trackid] = rg_simple_tags(self.utils.ref_loudness, track["gain"],
+                                                 track["range"], track["peak"], album)
+        if not track_tags:
+            return False
+        started, spawns_before = time.time(), SPAWNS[0]
+        if not self.__write_tags(track_tags) and not self.__apply_tags(track_tags,
+                                                                        self.get_path()):
+            self.metric_stage("tag", started, spawns_before)
+            return False
+        self.metric_stage("tag", started, spawns_before)
+        started, spawns_before = time.time(), SPAWNS[0]
+        verified = self.utils.check_tags(self.get_path(), False)
+        if self.utils.verify:
+            self.metric_stage("verify", started, spawns_before)
+        return verified
+
+    def __write_tags(self, track_tags):
+        """Write the tags in place, return False if mkvpropedit has to be used instead."""
+        try:
+            if MatroskaTagWriter(MatroskaInfo(self.get_path())).write(track_tags):
+                self.utils.log.debug(self.s_thread + "Wrote tags in place (" + self.get_path() + ")")
+                return True
+        except (IOError, OSError, ValueError) as error:
+            self.utils.log.debug(self.s_thread + "Could not write tags in place: {} ({})"
+                                 .format(error, self.get_path()))
+        return False
+
+    def __write_xml_file(self, path, tmp_file, simple_tags):
+        """Write XML file with the tags of a track to a temp file, for mkvpropedit."""
+        self.xml_utils.set_rg_tags(simple_tags)
+        self.xml_utils.write_rg_xml(tmp_file)
+        if os.path.getsize(tmp_file) == 0:
             self.utils.log.error(
                 self.s_thread + "Could not write XML to temp file (" + path + ")")
             return False
         return True
 
-    def __apply_tags(self, trackid, path):
-        """Apply replaygain tags with mkvpropedit."""
-        if not run_command("mkvpropedit --tags track:" + str(int(trackid) + 1) +
-                           ":" + self.tmp_file + " " + path):
+    def __apply_tags(self, track_tags, path):
+        """Apply the replaygain tags of all tracks with a single mkvpropedit run."""
+        tmp_files = []
+        command = "mkvpropedit"
+        for trackid, simple_tags in track_tags.items():
+            tmp = MakeTmpFile()
+            if not self.__write_xml_file(path, tmp.path, simple_tags):
+                return False
+            tmp_files.append(tmp)
+            command += " --tags track:" + str(int(trackid) + 1) + ":" + tmp.path
+        if not run_command(command + " " + path):
             self.utils.log.error(
                 self.s_thread + "Problem applying replaygain tags to " + path)
             return False
         return True
 
     def process_file(self):
-        """Process a matroska file, analyzing it with bs1770gain and applying tags."""
+        """
+        Process a matroska file, analyzing it with bs1770gain or natively and applying tags.
+        With --album the tags are applied later by AlbumGain, the measurements are returned.
+        """
+        started = time.time()
         self.utils.log.info(self.s_thread + "Processing file: " + self.get_path())
-        self.get_tracks(self.get_path())
-        self.__process_tracks()
+        if self.utils.album:
+            # The file metrics are logged by AlbumGain once the tags are applied.
+            measured = self.measure_tracks()
+            self.utils.log.info(self.s_thread + "Finished measuring file " + self.get_path())
+            return measured
+        if not self.utils.check_tags(self.get_path(), info=self.info):
+            self.metric_file(started, "skipped")
+            return None
+        tagged = self.tag_tracks(self.measure_tracks())
+        self.metric_file(started, "tagged" if tagged else "failed")
         self.utils.log.info(self.s_thread + "Finished processing file " + self.get_path())
+        return None
 
     def has_audio(self):
         # initialize self.tracks simply by checking if file has audio
         if not self.tracks:
-            self.get_tracks(self.get_path())
+            self.get_tracks(self.info)
         return True if self.tracks else False
 
 